@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
-import json
 import os
+import shutil
 import sys
-from subprocess import check_output
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, check_output
 
 import psycopg2
 
@@ -12,6 +17,10 @@ TARGET_DB = os.environ['TARGET_DB']
 ROW_LIMIT = os.environ.get('ROW_LIMIT', 10000)
 SAMPLED_TABLES = set(os.environ['SAMPLED_TABLES'].split(',')) if 'SAMPLED_TABLES' in os.environ else set()
 SKIPPED_TABLES = set(os.environ['SKIPPED_TABLES'].split(','))  if 'SKIPPED_TABLES' in os.environ else set()
+DUMP_JOBS = int(os.environ.get('DUMP_JOBS', 8))
+ID_CHUNK_SIZE = 10000
+OUTPUT_BUFFER_SIZE = 1 << 20
+SPOOL_SIZE = 32 << 20
 
 BEGIN_DUMP = '''
 --
@@ -29,6 +38,8 @@ SET client_encoding = 'UTF8';
 SET standard_conforming_strings = on;
 SET check_function_bodies = false;
 SET client_min_messages = warning;
+SET synchronous_commit = off;
+SET maintenance_work_mem = '1GB';
 
 SET search_path = public, pg_catalog;
 '''
@@ -49,18 +60,16 @@ AND table_schema = 'public'
 AND table_type = 'BASE TABLE'
 AND table_name NOT IN %s"""
 
-GET_COLUMNS_SQL = """SELECT a.attname as colname, format_type(a.atttypid, a.atttypmod) as coltype
+GET_COLUMNS_SQL = """SELECT c.relname, a.attname as colname
 FROM pg_catalog.pg_attribute a
+JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
 WHERE
-        attrelid = %s::regclass
-        AND attnum > 0
-        AND attisdropped = FALSE
-        ORDER BY attnum"""
-
-GET_FK_CONSTRAINTS_SQL = """SELECT conname,
-  pg_catalog.pg_get_constraintdef(r.oid, true) as condef
-FROM pg_catalog.pg_constraint r
-WHERE r.conrelid = %s::regclass AND r.contype = 'f'"""
+        n.nspname = 'public'
+        AND c.relname = ANY(%(tables)s)
+        AND a.attnum > 0
+        AND a.attisdropped = FALSE
+        ORDER BY c.relname, a.attnum"""
 
 BEGIN_TABLE_DUMP = '''
 --
@@ -70,159 +79,164 @@ BEGIN_TABLE_DUMP = '''
 COPY public."{table}" ({columns}) FROM STDIN;
 '''
 
-END_TABLE_DUMP = '''\.
+END_TABLE_DUMP = b'''\\.
 '''
 
 
-def get_tables(cursor, dbname, sampled_tables, row_limit, skipped_tables=None):
+def get_tables(conn_factory, dbname, sampled_tables, row_limit, skipped_tables=None):
     skipped_tables = skipped_tables.union(sampled_tables) or sampled_tables
-    cursor.execute(LIST_TABLES_SQL, (dbname, tuple(skipped_tables)))
-    rows = cursor.fetchall()
 
-    tables = {Table(t[0], cursor) for t in rows}
+    with conn_factory().cursor() as cursor:
+        cursor.execute(LIST_TABLES_SQL, (dbname, tuple(skipped_tables)))
+        names = [r[0] for r in cursor.fetchall()]
+        columns = get_columns(cursor, names + list(sampled_tables))
+
+    tables = [Table(t, conn_factory, columns[t]) for t in sorted(set(names))]
 
-    sampled_tables = {Table(t, cursor, limit=row_limit) for t in sampled_tables}
+    sampled_tables = [Table(t, conn_factory, columns[t], limit=row_limit) for t in sorted(sampled_tables)]
     return tables, sampled_tables
 
 
-class FkConstraint:
-    def __init__(self, table, name, condef):
-        self.table = table
-        self.name = name
-        self.condef = condef
+def get_columns(cursor, tables):
+    '''
+    Fetch the column names of all given tables in a single query.
+    '''
+    cursor.execute(GET_COLUMNS_SQL, {'tables': list(tables)})
 
-    @property
-    def drop(self):
-        return 'ALTER TABLE ONLY public."{}" DROP CONSTRAINT IF EXISTS {};\n'.format(self.table, self.name)
+    columns = {t: [] for t in tables}
+    for table, colname in cursor.fetchall():
+        columns[table].append(colname)
 
-    @property
-    def create(self):
-        return 'ALTER TABLE ONLY public."{}" ADD CONSTRAINT {} {};\n'.format(self.table, self.name, self.condef)
+    return columns
 
 
-class Table:
-    def __init__(self, name, cursor, limit=None):
-        self.name = name
-        self.cursor = cursor
-        self.limit = limit
-        self.ids = None
-        self._foreign_tables = {}
-        self._columns = None
-        self._coltypes = None
-        self._foreign_keys = None
-        self._ididx = None
-
-    @property
-    def columns(self):
-        if self._columns is None:
-            self.cursor.execute(GET_COLUMNS_SQL, (self.name,))
-            rows = self.cursor.fetchall()
-            self._columns = [r[0] for r in rows]
-            self._coltypes = [r[1] for r in rows]
-
-        return self._columns
-
-    @property
-    def foreign_key_constraints(self):
-        if self._foreign_keys is None:
-            self.cursor.execute(GET_FK_CONSTRAINTS_SQL, (self.name,))
-            rows = self.cursor.fetchall()
-            self._foreign_keys = [FkConstraint(self.name, row[0], row[1]) for row in rows]
-
-        return self._foreign_keys
-
-    @property
-    def ididx(self):
-        if self._ididx is None:
-            self._ididx = 0
-            for c in self.columns:
-                if c == 'id':
-                    return self._ididx
-                self._ididx += 1
-        return self._ididx
+def chunked(ids):
+    return [ids[i:i + ID_CHUNK_SIZE] for i in range(0, len(ids), ID_CHUNK_SIZE)]
 
-    def dump(self, outfile):
-        columns = ','.join(['"{}"'.format(c) for c in self.columns])
 
-        if self.limit is None:
-            self._copy(outfile, columns)
-        else:
-            self.ids = self._select_and_insert(outfile, columns)
+class ThreadLocalConnections:
+    '''
+    Connection factory that gives every thread its own connection to dsn. A dedicated connection exports a snapshot
+    on construction and every connection handed out imports it, so all threads read the same consistent state of the
+    database. The exported snapshot can only be imported while the exporting transaction is open, so that connection is
+    never handed out and stays idle in its transaction until close().
+    '''
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+        self._exporter = self._open()
+        with self._exporter.cursor() as cursor:
+            cursor.execute('SELECT pg_export_snapshot()')
+            self.snapshot = cursor.fetchone()[0]
 
-    def drop_foreign_key_constraints(self, outfile=sys.stdout):
-        for fk in self.foreign_key_constraints:
-            outfile.write(fk.drop)
-        outfile.write('\n')
+    def __call__(self):
+        pgcon = getattr(self._local, 'pgcon', None)
 
-    def create_foreign_key_constraints(self, outfile=sys.stdout):
-        for fk in self.foreign_key_constraints:
-            outfile.write(fk.create)
-        outfile.write('\n')
+        if pgcon is None:
+            pgcon = self._local.pgcon = self._connect()
 
-    def add_foreign_table(self, name, ids):
-        if name in self._foreign_tables:
-            raise RuntimeError('no bueno')
+        return pgcon
 
-        self._foreign_tables[name] = tuple(ids)
+    def close(self):
+        for pgcon in self._connections:
+            pgcon.close()
 
-    def _copy(self, outfile, columns):
-        outfile.write(BEGIN_TABLE_DUMP.format(table=self.name, columns=columns))
+    def _connect(self):
+        pgcon = self._open()
 
-        sql = 'COPY (SELECT {columns} FROM public."{table}" {where}) TO STDOUT'.format(table=self.name, columns=columns,
-                                                                                       where=self._build_where_clause())
-        self.cursor.copy_expert(sql, outfile)
-        outfile.write(END_TABLE_DUMP)
+        with pgcon.cursor() as cursor:
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', (self.snapshot,))
 
-    def _build_where_clause(self):
-        where = []
+        return pgcon
 
-        for ftable, fids in self._foreign_tables.items():
-            where.append('{foreign_table}_id in {ids}'.format(foreign_table=ftable, ids=fids))
+    def _open(self):
+        pgcon = psycopg2.connect(self.dsn)
+        pgcon.set_session(isolation_level='REPEATABLE READ', readonly=True)
 
-        return 'WHERE {}'.format(' AND '.join(where)) if len(where) > 0 else ''
+        with self._lock:
+            self._connections.append(pgcon)
 
-    def _select_and_insert(self, outfile, columns):
-        outfile.write('INSERT INTO {table} ({columns}) VALUES \n'.format(table=self.name, columns=columns))
-        sql = 'SELECT {columns} FROM public."{table}" LIMIT {limit}'.format(table=self.name, columns=columns, limit=self.limit)
-        self.cursor.execute(sql)
+        return pgcon
 
-        ids = []
-        rows_written = 1
-        for row in self.cursor:
-            ids.append(row[self.ididx])
-            outfile.write(self._mogrify_row(row))
 
-            if rows_written == self.cursor.rowcount:
-                outfile.write(';\n')
-            else:
-                outfile.write(',\n')
+class Table:
+    def __init__(self, name, conn_factory, columns, limit=None):
+        self.name = name
+        self.conn_factory = conn_factory
+        self.columns = columns
+        self.limit = limit
+        self.ids = None
+        self._foreign_tables = {}
 
-            rows_written += 1
+    @cached_property
+    def columns_sql(self):
+        return b','.join(b'"%b"' % c.encode() for c in self.columns)
 
-        outfile.write('\n')
-        return ids
+    @cached_property
+    def select_sql(self):
+        '''
+        SELECT of all columns with '%' escaped, for use in statements that go through cursor.mogrify().
+        '''
+        return (b'SELECT %b FROM public."%b"' % (self.columns_sql, self.name.encode())).replace(b'%', b'%%')
 
-    def _mogrify_row(self, row):
-        strrow = [self._stringify_value(v, i) for i, v in enumerate(row)]
-        return '({})'.format(','.join(strrow))
+    @cached_property
+    def begin_bytes(self):
+        return BEGIN_TABLE_DUMP.format(table=self.name, columns=self.columns_sql.decode()).encode()
 
-    def _stringify_value(self, value, colidx):
-        if value is None: return 'NULL'
+    def dump(self, outfile):
+        with self.conn_factory().cursor() as cursor:
+            outfile.write(self.begin_bytes)
 
-        coltype = self._coltypes[colidx]
-        fmtstr = "{}"
+            if self.limit is None:
+                self._copy(outfile, cursor)
+            else:
+                self.ids = self._select_and_insert(outfile, cursor)
 
-        if coltype.startswith('character') or coltype.startswith('geography') or coltype.startswith('json'):
-            fmtstr = "'{}'"
+            outfile.write(END_TABLE_DUMP)
 
-            if coltype.startswith('json'):
-                value = json.dumps(value)
+    def add_foreign_table(self, name, ids):
+        if name in self._foreign_tables:
+            raise RuntimeError('no bueno')
 
-        if coltype.startswith('timestamp'):
-            fmtstr = "'{}'"
-            value = value.isoformat()
+        self._foreign_tables[name] = list(ids)
+
+    def _copy(self, outfile, cursor):
+        # Text format on purpose: the data is inlined into a psql script, and psql reads binary COPY data
+        # until the end of its input stream instead of stopping at a terminator line.
+        for where, params in self._build_where_clauses():
+            sql = b'COPY (%b %b) TO STDOUT' % (self.select_sql, where.encode())
+            cursor.copy_expert(cursor.mogrify(sql, params), outfile)
+
+    def _build_where_clauses(self):
+        '''
+        Yield a (where clause, parameters) pair per chunk of ids. Only the longest foreign id list is split into chunks
+        of ID_CHUNK_SIZE and the others are passed whole, so the number of COPY statements grows linearly with the ids.
+        The chunks partition the rows, so the COPY outputs can be concatenated.
+        '''
+        if len(self._foreign_tables) == 0:
+            yield '', ()
+            return
+
+        ftables = sorted(self._foreign_tables.items(), key=lambda f: len(f[1]), reverse=True)
+        where = ' AND '.join('"{foreign_table}_id" = ANY(%s)'.format(foreign_table=ftable.replace('%', '%%'))
+                             for ftable, _ in ftables)
+        other_ids = [fids for _, fids in ftables[1:]]
+
+        for chunk in chunked(ftables[0][1]):
+            yield 'WHERE {}'.format(where), (chunk, *other_ids)
+
+    def _select_and_insert(self, outfile, cursor):
+        cursor.execute('SELECT id FROM public."{table}" LIMIT {limit}'.format(table=self.name, limit=self.limit))
+        ids = [r[0] for r in cursor.fetchall()]
+
+        sql = b'COPY (%b WHERE id = ANY(%%s)) TO STDOUT' % self.select_sql
+        for chunk in chunked(ids):
+            cursor.copy_expert(cursor.mogrify(sql, (chunk,)), outfile)
 
-        return fmtstr.format(value)
+        return ids
 
 
 def set_sampled_ids(sampled_tables, full_tables):
@@ -237,38 +251,79 @@ def set_sampled_ids(sampled_tables, full_tables):
                 t.add_foreign_table(sampled_table.name, sampled_table.ids)
 
 
+def dump_tables(executor, tables, outfile):
+    '''
+    Dump tables concurrently on the executor's threads and write the results to outfile in the given order. At most
+    DUMP_JOBS tables are in flight at once, and each one is spooled to a temporary file once it outgrows SPOOL_SIZE.
+    '''
+    pending = deque()
+
+    for t in tables:
+        if len(pending) >= DUMP_JOBS:
+            _write_spool(pending.popleft().result(), outfile)
+
+        pending.append(executor.submit(_dump_table, t))
+
+    while pending:
+        _write_spool(pending.popleft().result(), outfile)
+
+
+def _dump_table(table):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    table.dump(spool)
+    spool.seek(0)
+    return spool
+
+
+def _write_spool(spool, outfile):
+    with spool:
+        shutil.copyfileobj(spool, outfile)
+
+
 def sync_schema(source, target):
-    cmd = 'pg_dump --clean --create --no-owner --no-acl --format=p --schema-only {} | psql -q {}'.format(source, target)
-    return check_output(cmd, shell=True)
+    '''
+    Recreate the target database with the pre-data part of the source schema, i.e. without indexes, constraints and
+    triggers. Those are created by the post-data section at the end of the dump, after the data has been loaded.
+    '''
+    pg_dump_cmd = ['pg_dump', '--clean', '--create', '--no-owner', '--no-acl', '--format=p', '--section=pre-data',
+                   source]
+    psql_cmd = ['psql', '-q', target]
 
+    pg_dump = Popen(pg_dump_cmd, stdout=PIPE)
+    psql = Popen(psql_cmd, stdin=pg_dump.stdout, stdout=DEVNULL)
+    pg_dump.stdout.close()
 
-def main(outfile):
-    sync_schema(SOURCE_DB, TARGET_DB)
+    for proc, cmd in ((psql, psql_cmd), (pg_dump, pg_dump_cmd)):
+        if proc.wait() != 0:
+            raise CalledProcessError(proc.returncode, cmd)
 
-    with psycopg2.connect(SOURCE_DB) as pgcon:
-        dbname = pgcon.get_dsn_parameters()['dbname']
-        outfile.write(BEGIN_DUMP.format(dbname=dbname))
 
-        with pgcon.cursor() as cursor:
-            full_tables, sampled_tables = get_tables(cursor, dbname, SAMPLED_TABLES, ROW_LIMIT, skipped_tables=SKIPPED_TABLES)
-            tables = full_tables.union(sampled_tables)
+def dump_post_data(source, outfile):
+    outfile.write(check_output(['pg_dump', '--no-owner', '--no-acl', '--format=p', '--section=post-data', source]))
+
 
-            for t in tables:
-                t.drop_foreign_key_constraints(outfile)
+def main(outfile):
+    sync_schema(SOURCE_DB, TARGET_DB)
 
-            for t in sampled_tables:
-                t.dump(outfile)
+    connections = ThreadLocalConnections(SOURCE_DB)
 
-            set_sampled_ids(sampled_tables, full_tables)
+    try:
+        dbname = connections().get_dsn_parameters()['dbname']
+        outfile.write(BEGIN_DUMP.format(dbname=dbname).encode())
 
-            for t in full_tables:
-                t.dump(outfile)
+        full_tables, sampled_tables = get_tables(connections, dbname, SAMPLED_TABLES, ROW_LIMIT, skipped_tables=SKIPPED_TABLES)
 
-            for t in tables:
-                t.create_foreign_key_constraints(outfile)
+        with ThreadPoolExecutor(max_workers=DUMP_JOBS) as executor:
+            dump_tables(executor, sampled_tables, outfile)
+            set_sampled_ids(sampled_tables, full_tables)
+            dump_tables(executor, full_tables, outfile)
 
-            outfile.write(END_DUMP)
+        dump_post_data(SOURCE_DB, outfile)
+        outfile.write(END_DUMP.encode())
+    finally:
+        connections.close()
 
 
 if __name__ == '__main__':
-    main(sys.stdout)
+    with open(sys.stdout.fileno(), 'wb', buffering=OUTPUT_BUFFER_SIZE, closefd=False) as outfile:
+        main(outfile)